@@ -0,0 +1,96 @@
+# bench_render.py
+"""
+Микробенчмарк стоимости формирования одного ответа (без сети).
+
+"before" повторяет прежний путь: новая клавиатура-словарь на каждый ответ,
+json.dumps и urlencode всего тела. "after" использует подготовленные
+фрагменты из main.py.
+
+    TELEGRAM_TOKEN=x python bench_render.py
+"""
+import json
+import timeit
+import urllib.parse
+
+import main
+
+
+def old_keyboard():
+    return {
+        'keyboard': [
+            [{'text': '🖋️ Проверь себя'}, {'text': '🎯 Серия вопросов'}],
+            [{'text': '📊 Моя статистика'}],
+            [{'text': '🏆 Рейтинг'}, {'text': '📚 Словарь терминов'}],
+            [{'text': '📈 Полезные ссылки'}, {'text': '📒 Курс лекций'}],
+            [{'text': '❓ Помощь'}]
+        ],
+        'resize_keyboard': True
+    }
+
+
+def old_body(chat_id, text, reply_markup):
+    data = {'chat_id': str(chat_id), 'text': text[:4096], 'parse_mode': 'HTML'}
+    if reply_markup:
+        data['reply_markup'] = json.dumps(reply_markup, ensure_ascii=False)
+    return urllib.parse.urlencode(data, safe='', encoding='utf-8').encode('utf-8')
+
+
+class CaptureBot(main.TelegramBot):
+    def _request(self, method, data=None):
+        return data
+
+
+def old_stats(score):
+    percentage = round((score['correct'] / max(score['total'], 1)) * 100, 1)
+    text = (
+        f"📊 <b>Ваша статистика:</b>\n\n"
+        f"👤 Имя: {score.get('name','Аноним')}\n"
+        f"✅ Правильных ответов: {score['correct']}\n"
+        f"❌ Неправильных ответов: {score['incorrect']}\n"
+        f"📝 Всего вопросов: {score['total']}\n"
+        f"📈 Процент правильных: {percentage}%\n\n"
+    )
+    if percentage >= 90:
+        text += "🏆 <b>Уровень: Эксперт по экономике!</b>"
+    elif percentage >= 75:
+        text += "🥇 <b>Уровень: Продвинутый</b>"
+    elif percentage >= 60:
+        text += "🥈 <b>Уровень: Хороший</b>"
+    elif percentage >= 40:
+        text += "🥉 <b>Уровень: Базовый</b>"
+    else:
+        text += "📚 <b>Уровень: Начинающий</b>"
+    return old_body(123456789, text, old_keyboard())
+
+
+def new_stats(bot, score):
+    percentage = round((score['correct'] / max(score['total'], 1)) * 100, 1)
+    level = next(text for threshold, text in main.STATS_LEVELS if percentage >= threshold)
+    text = main.STATS_TEMPLATE.format(
+        name=score.get('name', 'Аноним'), correct=score['correct'], incorrect=score['incorrect'],
+        total=score['total'], percentage=percentage, level=level
+    )
+    return bot.send_message(123456789, text, main.MAIN_KEYBOARD)
+
+
+if __name__ == "__main__":
+    bot = CaptureBot('x')
+    score = {'name': 'Аноним', 'correct': 7, 'incorrect': 3, 'total': 10}
+
+    # подготовленные ответы должны совпадать с прежними байт в байт
+    assert bot.send_message(123456789, main.HELP_MESSAGE) == old_body(123456789, main.HELP_MESSAGE.text, old_keyboard())
+    assert new_stats(bot, score) == old_stats(score)
+
+    cases = [
+        ("help (static)",
+         lambda: old_body(123456789, main.HELP_MESSAGE.text, old_keyboard()),
+         lambda: bot.send_message(123456789, main.HELP_MESSAGE)),
+        ("stats (templated)",
+         lambda: old_stats(score),
+         lambda: new_stats(bot, score)),
+    ]
+    number = 20000
+    for name, before, after in cases:
+        t_before = min(timeit.repeat(before, number=number, repeat=5)) / number * 1e6
+        t_after = min(timeit.repeat(after, number=number, repeat=5)) / number * 1e6
+        print(f"{name:20s} before {t_before:7.2f} us/reply   after {t_after:7.2f} us/reply   x{t_before / t_after:.1f}")
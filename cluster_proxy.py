@@ -0,0 +1,69 @@
+# cluster_proxy.py
+"""
+Локальный round-robin прокси для проверки кластерного режима.
+
+Пример (три узла и прокси на 8080):
+
+    CLUSTER_SECRET=local CLUSTER_NODES=http://127.0.0.1:8081,http://127.0.0.1:8082,http://127.0.0.1:8083 \\
+    CLUSTER_SELF_URL=http://127.0.0.1:8081 PORT=8081 python main.py
+    ... (то же для 8082 и 8083)
+    python cluster_proxy.py 8080 http://127.0.0.1:8081 http://127.0.0.1:8082 http://127.0.0.1:8083
+
+Апдейты, отправленные на http://127.0.0.1:8080/webhook, попадают на случайный
+узел и маршрутизируются узлами к владельцу чата.
+"""
+import itertools
+import sys
+import threading
+import urllib.error
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def make_handler(backends):
+    cycle = itertools.cycle(backends)
+    lock = threading.Lock()
+
+    class ProxyHandler(BaseHTTPRequestHandler):
+        def _forward(self, method):
+            length = int(self.headers.get('Content-Length', 0))
+            body = self.rfile.read(length) if length else None
+            # пропускаем недоступные узлы, как это делает балансировщик Fly
+            for _ in range(len(backends)):
+                with lock:
+                    backend = next(cycle)
+                req = urllib.request.Request(f"{backend}{self.path}", data=body, method=method)
+                for name in ('Content-Type', 'X-Telegram-Bot-Api-Secret-Token'):
+                    if self.headers.get(name):
+                        req.add_header(name, self.headers[name])
+                try:
+                    with urllib.request.urlopen(req, timeout=10) as resp:
+                        status, payload = resp.status, resp.read()
+                except urllib.error.HTTPError as e:
+                    status, payload = e.code, e.read()
+                except Exception:
+                    continue
+                self.send_response(status)
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+                return
+            self.send_error(502, "No backend available")
+
+        def do_GET(self):
+            self._forward('GET')
+
+        def do_POST(self):
+            self._forward('POST')
+
+    return ProxyHandler
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        print("Usage: python cluster_proxy.py <port> <backend_url> [<backend_url> ...]")
+        sys.exit(1)
+    port = int(sys.argv[1])
+    backends = [b.rstrip('/') for b in sys.argv[2:]]
+    print(f"Proxying 0.0.0.0:{port} -> {', '.join(backends)}")
+    ThreadingHTTPServer(('0.0.0.0', port), make_handler(backends)).serve_forever()
@@ -1,16 +1,28 @@
 # main.py
 import os
+import bisect
+import collections
+import hashlib
+import hmac
 import logging
 import json
 import random
 import sys
+import math
 import time
 import threading
+import urllib.error
 import urllib.request
 import urllib.parse
 from dotenv import load_dotenv
 from flask import Flask, request, jsonify
 
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:  # orjson is optional, fall back to the stdlib decoder
+    json_loads = json.loads
+
 # -------------------------
 # Configuration / Logging
 # -------------------------
@@ -34,6 +46,36 @@ TOKEN = os.getenv('TELEGRAM_TOKEN')
 APP_NAME = os.getenv('APP_NAME')        # optional, used to form webhook URL if WEBHOOK_URL not provided
 WEBHOOK_URL = os.getenv('WEBHOOK_URL')  # if provided, will be used as webhook endpoint
 PORT = int(os.environ.get('PORT', 8080))
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')  # sent by Telegram in X-Telegram-Bot-Api-Secret-Token; must match across nodes
+
+# Update types process_update handles; everything else is neither requested nor processed
+ALLOWED_UPDATES = ['message', 'callback_query']
+
+# Difficulty / time limit recalibration from real answer data
+CALIBRATION_INTERVAL = int(os.environ.get('CALIBRATION_INTERVAL', 600))     # seconds between recalibration runs, 0 disables
+CALIBRATION_MIN_SAMPLES = int(os.environ.get('CALIBRATION_MIN_SAMPLES', 20))
+MIN_TIME_LIMIT = int(os.environ.get('MIN_TIME_LIMIT', 10))
+MAX_TIME_LIMIT = int(os.environ.get('MAX_TIME_LIMIT', 40))
+
+QUIZ_RUN_LENGTH = int(os.environ.get('QUIZ_RUN_LENGTH', 10))  # questions per quiz run
+QUIZ_RUN_MAX_TIMEOUTS = int(os.environ.get('QUIZ_RUN_MAX_TIMEOUTS', 2))  # consecutive timeouts that end a run
+
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL', 'https://api.telegram.org')  # override to point at a local stub
+
+# Cluster mode: updates are routed by chat_id to an owning node (consistent hashing),
+# sessions are replicated to the next node on the ring. Disabled unless CLUSTER_NODES is set.
+CLUSTER_NODES = [n.strip() for n in os.getenv('CLUSTER_NODES', '').split(',') if n.strip()]  # e.g. http://10.0.0.1:8080,http://10.0.0.2:8080
+CLUSTER_SELF_URL = os.getenv('CLUSTER_SELF_URL', f"http://127.0.0.1:{PORT}")  # this node's address as listed in CLUSTER_NODES
+CLUSTER_SECRET = os.getenv('CLUSTER_SECRET')  # shared by all nodes, required in cluster mode
+CLUSTER_REPLICAS = int(os.environ.get('CLUSTER_REPLICAS', 1))
+CLUSTER_HEARTBEAT = float(os.environ.get('CLUSTER_HEARTBEAT', 2))
+CLUSTER_VNODES = 64
+
+# Profiling: per-update stage timings and a slow-update log (opt-in), sampling profiler via /admin/profiler
+PROFILE_UPDATES = os.getenv('PROFILE_UPDATES', '0') == '1'
+SLOW_UPDATE_MS = float(os.environ.get('SLOW_UPDATE_MS', 500))
+SLOW_UPDATE_SAMPLE = float(os.environ.get('SLOW_UPDATE_SAMPLE', 1.0))  # fraction of slow updates that get logged
+ADMIN_TOKEN = os.getenv('ADMIN_TOKEN')  # required for /admin/* endpoints, which are disabled without it
 
 # -------------------------
 # Simple environment checks
@@ -42,6 +84,10 @@ if not TOKEN:
     logger.error("TELEGRAM_TOKEN is not set. Please set it in environment or via fly secrets.")
     sys.exit(1)
 
+if CLUSTER_NODES and not CLUSTER_SECRET:
+    logger.error("CLUSTER_SECRET is not set. It is required when CLUSTER_NODES is set.")
+    sys.exit(1)
+
 # -------------------------
 # State and questions
 # -------------------------
@@ -436,6 +482,120 @@ quiz_questions = [
     }
 ]
 
+# -------------------------
+# Profiling
+# -------------------------
+class UpdateProfiler:
+    """Тайминги стадий обработки апдейтов и статистический профилировщик"""
+    def __init__(self, spans=False, slow_ms=500, sample_rate=1.0, sample_interval=0.01):
+        self.spans = spans
+        self.slow_ms = slow_ms
+        self.sample_rate = sample_rate
+        self.sample_interval = sample_interval
+        self.enabled = spans          # единственная проверка на горячем пути, когда всё выключено
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.stage_totals = {}        # stage -> [count, seconds]
+        self.active = {}              # ident потока -> апдейт, который он обрабатывает
+        self.stacks = collections.Counter()
+        self.sampler = None
+        self.sampler_stop = threading.Event()
+
+    def _refresh(self):
+        self.enabled = self.spans or self.sampler is not None
+
+    def set_spans(self, value):
+        self.spans = value
+        self._refresh()
+
+    def begin(self, update):
+        self.local.stages = {}
+        self.active[threading.get_ident()] = update
+        return time.perf_counter()
+
+    def add(self, stage, elapsed):
+        stages = getattr(self.local, 'stages', None)
+        if stages is not None:
+            stages[stage] = stages.get(stage, 0.0) + elapsed
+
+    def end(self, start, update):
+        total = time.perf_counter() - start
+        stages = self.local.stages
+        self.local.stages = None
+        self.active.pop(threading.get_ident(), None)
+        if not self.spans:
+            return
+
+        stages['handler'] = max(0.0, total - sum(stages.values()))
+        with self.lock:
+            for stage, elapsed in list(stages.items()) + [('total', total)]:
+                entry = self.stage_totals.setdefault(stage, [0, 0.0])
+                entry[0] += 1
+                entry[1] += elapsed
+
+        if total * 1000 >= self.slow_ms and random.random() < self.sample_rate:
+            kind = 'callback_query' if 'callback_query' in update else 'message'
+            breakdown = ', '.join(
+                f"{stage}={elapsed * 1000:.1f}ms"
+                for stage, elapsed in sorted(stages.items(), key=lambda item: -item[1])
+            )
+            logger.warning(
+                f"Slow update {update.get('update_id')} ({kind}, chat {update_chat_id(update)}): "
+                f"{total * 1000:.1f}ms [{breakdown}]"
+            )
+
+    def start_sampler(self):
+        with self.lock:
+            if self.sampler is not None:
+                return
+            self.stacks.clear()
+            self.sampler_stop.clear()
+            self.sampler = threading.Thread(target=self._sample_loop, daemon=True)
+            self.sampler.start()
+            self._refresh()
+
+    def stop_sampler(self):
+        with self.lock:
+            thread, self.sampler = self.sampler, None
+            self._refresh()
+        if thread is not None:
+            self.sampler_stop.set()
+            thread.join()
+
+    def _sample_loop(self):
+        # сэмплируем только потоки, которые сейчас обрабатывают апдейт
+        while not self.sampler_stop.wait(self.sample_interval):
+            frames = sys._current_frames()
+            samples = []
+            for ident in list(self.active):
+                frame = frames.get(ident)
+                stack = []
+                while frame is not None and len(stack) < 40:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                    frame = frame.f_back
+                if stack:
+                    samples.append(';'.join(reversed(stack)))
+            # report() читает счётчик из потока запроса
+            with self.lock:
+                self.stacks.update(samples)
+
+    def report(self, limit=20):
+        with self.lock:
+            stages = {
+                stage: {'count': count, 'total_ms': round(seconds * 1000, 1), 'avg_ms': round(seconds * 1000 / count, 2)}
+                for stage, (count, seconds) in self.stage_totals.items()
+            }
+            hot_stacks = self.stacks.most_common(limit)
+        return {
+            'spans': self.spans,
+            'sampler': self.sampler is not None,
+            'stages': stages,
+            'hot_stacks': [{'stack': stack, 'samples': n} for stack, n in hot_stacks]
+        }
+
+profiler = UpdateProfiler(PROFILE_UPDATES, SLOW_UPDATE_MS, SLOW_UPDATE_SAMPLE)
+
 # -------------------------
 # Timer manager (for timeouts)
 # -------------------------
@@ -445,8 +605,17 @@ class TimerManager:
         self.timers = {}
         self.lock = threading.Lock()
 
+    def _acquire(self):
+        if profiler.enabled:
+            start = time.perf_counter()
+            self.lock.acquire()
+            profiler.add('timer_lock', time.perf_counter() - start)
+        else:
+            self.lock.acquire()
+
     def set_timer(self, key, delay, callback, *args):
-        with self.lock:
+        self._acquire()
+        try:
             if key in self.timers:
                 try:
                     self.timers[key].cancel()
@@ -456,15 +625,20 @@ class TimerManager:
             timer.daemon = True
             self.timers[key] = timer
             timer.start()
+        finally:
+            self.lock.release()
 
     def cancel_timer(self, key):
-        with self.lock:
+        self._acquire()
+        try:
             if key in self.timers:
                 try:
                     self.timers[key].cancel()
                 except Exception:
                     pass
                 del self.timers[key]
+        finally:
+            self.lock.release()
 
     def _timer_callback(self, key, callback, args):
         try:
@@ -473,27 +647,321 @@ class TimerManager:
             logger.error(f"Timer callback error: {e}")
         finally:
             with self.lock:
-                if key in self.timers:
+                # колбэк мог уже поставить следующий таймер под тем же ключом
+                if self.timers.get(key) is threading.current_thread():
                     del self.timers[key]
 
 timer_manager = TimerManager()
 
+# -------------------------
+# Response-time statistics and calibration
+# -------------------------
+class P2Quantile:
+    """Потоковая оценка квантиля (алгоритм P², Jain & Chlamtac) за O(1) памяти"""
+    def __init__(self, p):
+        self.p = p
+        self.count = 0
+        self.q = []                                   # высоты маркеров
+        self.n = [0, 1, 2, 3, 4]                      # позиции маркеров
+        self.np = [0, 2 * p, 4 * p, 2 + 2 * p, 4]     # желаемые позиции
+        self.dn = [0, p / 2, p, (1 + p) / 2, 1]       # приращения желаемых позиций
+
+    def add(self, x):
+        self.count += 1
+        if self.count <= 5:
+            self.q.append(x)
+            if self.count == 5:
+                self.q.sort()
+            return
+
+        q, n = self.q, self.n
+        if x < q[0]:
+            q[0] = x
+            k = 0
+        elif x >= q[4]:
+            q[4] = x
+            k = 3
+        else:
+            k = 0
+            while x >= q[k + 1]:
+                k += 1
+
+        for i in range(k + 1, 5):
+            n[i] += 1
+        for i in range(5):
+            self.np[i] += self.dn[i]
+
+        for i in range(1, 4):
+            d = self.np[i] - n[i]
+            if (d >= 1 and n[i + 1] - n[i] > 1) or (d <= -1 and n[i - 1] - n[i] < -1):
+                d = 1 if d > 0 else -1
+                candidate = self._parabolic(i, d)
+                if not q[i - 1] < candidate < q[i + 1]:
+                    candidate = q[i] + d * (q[i + d] - q[i]) / (n[i + d] - n[i])
+                q[i] = candidate
+                n[i] += d
+
+    def _parabolic(self, i, d):
+        q, n = self.q, self.n
+        return q[i] + d / (n[i + 1] - n[i - 1]) * (
+            (n[i] - n[i - 1] + d) * (q[i + 1] - q[i]) / (n[i + 1] - n[i])
+            + (n[i + 1] - n[i] - d) * (q[i] - q[i - 1]) / (n[i] - n[i - 1])
+        )
+
+    def value(self):
+        if self.count == 0:
+            return None
+        if self.count < 5:
+            ordered = sorted(self.q)
+            return ordered[min(int(self.p * len(ordered)), len(ordered) - 1)]
+        return self.q[2]
+
+
+class QuestionStats:
+    """Накопленная статистика ответов на один вопрос"""
+    def __init__(self):
+        self.answered = 0
+        self.correct = 0
+        self.timeouts = 0
+        self.p50 = P2Quantile(0.5)
+        self.p90 = P2Quantile(0.9)
+
+    @property
+    def total(self):
+        return self.answered + self.timeouts
+
+    def accuracy(self):
+        return self.correct / self.total if self.total else None
+
+
+question_stats = {}
+stats_lock = threading.Lock()
+# исходные лимиты из quiz_questions: от них, а не от прошлой калибровки, считается надбавка за таймауты
+BASE_TIME_LIMITS = {q['question']: q['time_limit'] for q in quiz_questions}
+
+def record_answer(question, elapsed, is_correct):
+    with stats_lock:
+        stats = question_stats.setdefault(question['question'], QuestionStats())
+        stats.answered += 1
+        if is_correct:
+            stats.correct += 1
+        stats.p50.add(elapsed)
+        stats.p90.add(elapsed)
+
+def record_timeout(question, time_limit):
+    with stats_lock:
+        stats = question_stats.setdefault(question['question'], QuestionStats())
+        stats.timeouts += 1
+        # не ответивший студент потратил как минимум весь лимит — без этого квантили занижены
+        stats.p50.add(time_limit)
+        stats.p90.add(time_limit)
+
+def recalibrate_questions():
+    """Пересчитывает difficulty и time_limit по реальным ответам"""
+    changed = 0
+    with stats_lock:
+        for question in quiz_questions:
+            stats = question_stats.get(question['question'])
+            if not stats or stats.total < CALIBRATION_MIN_SAMPLES:
+                continue
+
+            accuracy = stats.accuracy()
+            if accuracy >= 0.8:
+                difficulty = 'easy'
+            elif accuracy >= 0.5:
+                difficulty = 'medium'
+            else:
+                difficulty = 'hard'
+
+            p90 = stats.p90.value()
+            # запас на чтение вариантов и сетевую задержку
+            time_limit = math.ceil(p90 * 1.25 + 3)
+            timeout_rate = stats.timeouts / stats.total
+            # заметная доля таймаутов — лимит не снижаем
+            if timeout_rate > 0.05:
+                time_limit = max(time_limit, question['time_limit'])
+            # при частых таймаутах не опускаемся ниже исходного лимита с надбавкой
+            if timeout_rate > 0.2:
+                time_limit = max(time_limit, BASE_TIME_LIMITS[question['question']] + 5)
+            time_limit = max(MIN_TIME_LIMIT, min(MAX_TIME_LIMIT, time_limit))
+
+            if difficulty != question.get('difficulty') or time_limit != question['time_limit']:
+                logger.info(
+                    f"Recalibrated '{question['question'][:40]}': "
+                    f"difficulty {question.get('difficulty')} -> {difficulty}, "
+                    f"time_limit {question['time_limit']} -> {time_limit} "
+                    f"(n={stats.total}, acc={accuracy:.2f}, p50={stats.p50.value()}, p90={p90})"
+                )
+                question['difficulty'] = difficulty
+                question['time_limit'] = time_limit
+                changed += 1
+    return changed
+
+def start_calibration_job():
+    if CALIBRATION_INTERVAL <= 0:
+        return None
+
+    def loop():
+        while True:
+            time.sleep(CALIBRATION_INTERVAL)
+            try:
+                recalibrate_questions()
+            except Exception as e:
+                logger.error(f"Calibration error: {e}")
+
+    thread = threading.Thread(target=loop, daemon=True)
+    thread.start()
+    return thread
+
+# -------------------------
+# Message rendering (prepared payload fragments)
+# -------------------------
+def encode_field(name, value):
+    """Кодирует одно поле формы так же, как urlencode(..., safe='')"""
+    return f"{name}={urllib.parse.quote_plus(value, safe='')}"
+
+class PreparedMarkup:
+    """Клавиатура, заранее сериализованная в JSON и закодированная для тела запроса"""
+    __slots__ = ('encoded',)
+
+    def __init__(self, markup):
+        self.encoded = encode_field('reply_markup', json.dumps(markup, ensure_ascii=False)).encode('utf-8')
+
+class PreparedMessage:
+    """Статический ответ: текст, parse_mode и клавиатура закодированы один раз"""
+    __slots__ = ('text', 'encoded')
+
+    def __init__(self, text, reply_markup=None):
+        self.text = text[:4096]
+        encoded = encode_field('text', self.text) + '&parse_mode=HTML'
+        self.encoded = encoded.encode('utf-8')
+        if reply_markup:
+            self.encoded += b'&' + reply_markup.encoded
+
+MAIN_KEYBOARD = PreparedMarkup({
+    'keyboard': [
+        [{'text': '🖋️ Проверь себя'}, {'text': '🎯 Серия вопросов'}],
+        [{'text': '📊 Моя статистика'}],
+        [{'text': '🏆 Рейтинг'}, {'text': '📚 Словарь терминов'}],
+        [{'text': '📈 Полезные ссылки'}, {'text': '📒 Курс лекций'}],
+        [{'text': '❓ Помощь'}]
+    ],
+    'resize_keyboard': True
+})
+
+QUIZ_KEYBOARD = PreparedMarkup({
+    'inline_keyboard': [
+        [
+            {'text': 'А', 'callback_data': 'quiz_А'},
+            {'text': 'Б', 'callback_data': 'quiz_Б'},
+            {'text': 'В', 'callback_data': 'quiz_В'}
+        ]
+    ]
+})
+
+# в серии номер вопроса входит в callback_data, чтобы повторное нажатие не засчиталось следующему вопросу
+RUN_KEYBOARDS = [
+    PreparedMarkup({
+        'inline_keyboard': [
+            [{'text': letter, 'callback_data': f'quiz_{letter}_{pos}'} for letter in ('А', 'Б', 'В')]
+        ]
+    })
+    for pos in range(QUIZ_RUN_LENGTH)
+]
+
+GREETING_MESSAGE = PreparedMessage("👋 Привет! Я бот по экономической теории. Используй меню ниже.", MAIN_KEYBOARD)
+HELP_MESSAGE = PreparedMessage(
+    "❓ <b>Помощь</b>\n\n"
+    "• Нажмите <b>🖋️ Проверь себя</b> чтобы начать случайный вопрос.\n"
+    f"• <b>🎯 Серия вопросов</b> — {QUIZ_RUN_LENGTH} вопросов подряд, /run <i>тема</i> — серия по одной теме.\n"
+    "• Используйте кнопки в викторине (А/Б/В) для ответа.\n"
+    "• Команда /start — приветствие.",
+    MAIN_KEYBOARD
+)
+FALLBACK_MESSAGE = PreparedMessage("Я вас не понял. Используйте кнопки меню.", MAIN_KEYBOARD)
+NO_STATS_MESSAGE = PreparedMessage("📊 У вас пока нет статистики. Начните викторину!", MAIN_KEYBOARD)
+CORRECT_MESSAGE = PreparedMessage("✅ <b>Правильно!</b>", MAIN_KEYBOARD)
+INCORRECT_MESSAGES = {
+    letter: PreparedMessage(f"❌ Неверно. Правильный ответ: <b>{letter}</b>", MAIN_KEYBOARD)
+    for letter in ('А', 'Б', 'В')
+}
+
+RUN_TOPIC_NOT_FOUND_TEMPLATE = "Тема не найдена. Доступные темы:\n{topics}"
+RUN_TIMEOUT_TEMPLATE = "⏰ Время вышло! Правильный ответ: <b>{correct}</b>"
+RUN_SUMMARY_TEMPLATE = (
+    "🏁 <b>Серия завершена!</b>\n"
+    "Правильных ответов: {correct} из {total} ({percentage}%)"
+)
+RUN_STOPPED_TEMPLATE = (
+    "⏹ <b>Серия остановлена.</b>\n"
+    "Правильных ответов: {correct} из {total} ({percentage}%)"
+)
+
+DIFFICULTY_EMOJI = {'easy': '🟢', 'medium': '🟡', 'hard': '🔴'}
+
+QUESTION_TEMPLATE = "🧠 {emoji} <b>{question}</b>\n\n{options}\n\n⏰ У вас есть <b>{time_limit}</b> секунд для ответа!"
+TIMEOUT_TEMPLATE = (
+    "⏰ Время вышло!\n"
+    "Правильный ответ: <b>{correct}</b>\n\n"
+    "📊 Ваша статистика:\n"
+    "Правильных ответов: {score_correct}\n"
+    "Всего вопросов: {total}\n"
+    "Процент правильных: {percentage}%"
+)
+STATS_TEMPLATE = (
+    "📊 <b>Ваша статистика:</b>\n\n"
+    "👤 Имя: {name}\n"
+    "✅ Правильных ответов: {correct}\n"
+    "❌ Неправильных ответов: {incorrect}\n"
+    "📝 Всего вопросов: {total}\n"
+    "📈 Процент правильных: {percentage}%\n\n"
+    "{level}"
+)
+STATS_LEVELS = (
+    (90, "🏆 <b>Уровень: Эксперт по экономике!</b>"),
+    (75, "🥇 <b>Уровень: Продвинутый</b>"),
+    (60, "🥈 <b>Уровень: Хороший</b>"),
+    (40, "🥉 <b>Уровень: Базовый</b>"),
+    (0, "📚 <b>Уровень: Начинающий</b>"),
+)
+
+def render_question(question):
+    return QUESTION_TEMPLATE.format(
+        emoji=DIFFICULTY_EMOJI.get(question.get('difficulty', ''), ''),
+        question=question['question'],
+        options="\n".join(question['options']),
+        time_limit=question['time_limit']
+    )
+
 # -------------------------
 # TelegramBot helper
 # -------------------------
 class TelegramBot:
     def __init__(self, token):
         self.token = token
-        self.api_url = f"https://api.telegram.org/bot{token}"
+        self.api_url = f"{TELEGRAM_API_URL}/bot{token}"
 
     def _request(self, method, data=None):
+        if profiler.enabled:
+            start = time.perf_counter()
+            try:
+                return self._do_request(method, data)
+            finally:
+                profiler.add('telegram', time.perf_counter() - start)
+        return self._do_request(method, data)
+
+    def _do_request(self, method, data=None):
         url = f"{self.api_url}/{method}"
         try:
             if data is None:
                 with urllib.request.urlopen(url, timeout=10) as resp:
                     return json.loads(resp.read().decode('utf-8'))
             else:
-                encoded = urllib.parse.urlencode(data, safe='', encoding='utf-8').encode('utf-8')
+                # bytes — уже закодированное тело запроса (см. PreparedMessage)
+                if isinstance(data, bytes):
+                    encoded = data
+                else:
+                    encoded = urllib.parse.urlencode(data, safe='', encoding='utf-8').encode('utf-8')
                 req = urllib.request.Request(url, data=encoded)
                 req.add_header('Content-Type', 'application/x-www-form-urlencoded; charset=utf-8')
                 with urllib.request.urlopen(req, timeout=10) as resp:
@@ -503,14 +971,16 @@ class TelegramBot:
             return None
 
     def send_message(self, chat_id, text, reply_markup=None):
-        data = {
-            'chat_id': str(chat_id),
-            'text': text[:4096],
-            'parse_mode': 'HTML'
-        }
-        if reply_markup:
-            data['reply_markup'] = json.dumps(reply_markup, ensure_ascii=False)
-        return self._request('sendMessage', data)
+        """text — строка или PreparedMessage; reply_markup — dict или PreparedMarkup"""
+        if isinstance(text, PreparedMessage):
+            return self._request('sendMessage', b'chat_id=%d&' % chat_id + text.encoded)
+
+        body = f"chat_id={chat_id}&{encode_field('text', text[:4096])}&parse_mode=HTML".encode('utf-8')
+        if isinstance(reply_markup, PreparedMarkup):
+            body += b'&' + reply_markup.encoded
+        elif reply_markup:
+            body += b'&' + encode_field('reply_markup', json.dumps(reply_markup, ensure_ascii=False)).encode('utf-8')
+        return self._request('sendMessage', body)
 
     def answer_callback(self, callback_query_id, text=None):
         data = {'callback_query_id': callback_query_id}
@@ -518,10 +988,12 @@ class TelegramBot:
             data['text'] = text
         return self._request('answerCallbackQuery', data)
 
-    def set_webhook(self, url, allowed_updates=None, drop_pending_updates=True):
+    def set_webhook(self, url, allowed_updates=None, drop_pending_updates=True, secret_token=None):
         data = {'url': url}
         if allowed_updates:
             data['allowed_updates'] = json.dumps(allowed_updates, ensure_ascii=False)
+        if secret_token:
+            data['secret_token'] = secret_token
         if drop_pending_updates:
             data['drop_pending_updates'] = 'true'
         return self._request('setWebhook', data)
@@ -529,58 +1001,114 @@ class TelegramBot:
 # -------------------------
 # Bot logic functions
 # -------------------------
-def get_main_keyboard():
-    return {
-        'keyboard': [
-            [{'text': '🖋️ Проверь себя'}, {'text': '📊 Моя статистика'}],
-            [{'text': '🏆 Рейтинг'}, {'text': '📚 Словарь терминов'}],
-            [{'text': '📈 Полезные ссылки'}, {'text': '📒 Курс лекций'}],
-            [{'text': '❓ Помощь'}]
-        ],
-        'resize_keyboard': True
-    }
-
-def quiz_question_single(chat_id, bot_obj):
-    question = random.choice(quiz_questions)
-    user_states[chat_id] = {
-        'mode': 'quiz',
-        'current_question': question,
-        'start_time': time.time(),
-        'answered': False
-    }
-
-    difficulty_emoji = {'easy': '🟢', 'medium': '🟡', 'hard': '🔴'}
-    emoji = difficulty_emoji.get(question.get('difficulty', ''), '')
-
-    text = f"🧠 {emoji} <b>{question['question']}</b>\n\n"
-    for opt in question['options']:
-        text += f"{opt}\n"
+QUIZ_TOPICS = list(dict.fromkeys(q['topic'] for q in quiz_questions))
+
+def find_topic(query):
+    query = query.strip().lower()
+    for topic in QUIZ_TOPICS:
+        if query in topic.lower():
+            return topic
+    return None
+
+def ask_question(chat_id, bot_obj, question, prefix=''):
+    state = user_states[chat_id]
+    now = time.time()
+    state['current_question'] = question
+    state['start_time'] = now
+    state['deadline'] = now + question['time_limit']
+    state['answered'] = False
+
+    run = state.get('run')
+    if run:
+        text = f"{prefix}({run['pos'] + 1}/{len(run['seq'])}) {render_question(question)}"
+        keyboard = RUN_KEYBOARDS[run['pos']]
+    else:
+        text = prefix + render_question(question)
+        keyboard = QUIZ_KEYBOARD
+    bot_obj.send_message(chat_id, text, keyboard)
 
-    inline_keyboard = {
-        'inline_keyboard': [
-            [
-                {'text': 'А', 'callback_data': 'quiz_А'},
-                {'text': 'Б', 'callback_data': 'quiz_Б'},
-                {'text': 'В', 'callback_data': 'quiz_В'}
-            ]
-        ]
-    }
+    # set timer for question timeout
+    timer_manager.set_timer(f"quiz_{chat_id}", question['time_limit'], question_timeout, chat_id, state['deadline'])
+
+answer_lock = threading.Lock()
+
+def claim_question(state, pos=None, deadline=None):
+    """Атомарно закрывает текущий вопрос; False — его уже закрыл ответ или таймаут.
+
+    pos (из callback_data серии) и deadline (с которым взведён таймер) отсекают
+    нажатия и таймеры, относящиеся к предыдущему вопросу.
+    """
+    with answer_lock:
+        if state.get('answered', False):
+            return False
+        run = state.get('run')
+        if run and pos is not None and pos != str(run['pos']):
+            return False
+        if deadline is not None and state.get('deadline') != deadline:
+            return False
+        state['answered'] = True
+        return True
 
-    text += f"\n⏰ У вас есть <b>{question['time_limit']}</b> секунд для ответа!"
-    bot_obj.send_message(chat_id, text, inline_keyboard)
+def quiz_question_single(chat_id, bot_obj):
+    user_states[chat_id] = {'mode': 'quiz'}
+    ask_question(chat_id, bot_obj, random.choice(quiz_questions))
 
-    # set timer for question timeout
-    timer_manager.set_timer(f"quiz_{chat_id}", question['time_limit'], question_timeout, chat_id)
+def start_quiz_run(chat_id, bot_obj, topic=None):
+    """Серия вопросов: последовательность выбирается сразу, в сессии хранятся только индексы"""
+    if topic:
+        pool = [i for i, q in enumerate(quiz_questions) if q['topic'] == topic]
+    else:
+        pool = range(len(quiz_questions))
+    seq = random.sample(pool, min(QUIZ_RUN_LENGTH, len(pool)))
+    user_states[chat_id] = {'mode': 'quiz', 'run': {'seq': seq, 'pos': 0, 'correct': 0, 'missed': 0}}
+    ask_question(chat_id, bot_obj, quiz_questions[seq[0]])
+
+def run_summary(run):
+    """Итог по закрытым вопросам серии; если серия прервана — сообщение об остановке"""
+    closed = run['pos']
+    template = RUN_SUMMARY_TEMPLATE if closed == len(run['seq']) else RUN_STOPPED_TEMPLATE
+    return template.format(
+        correct=run['correct'],
+        total=closed,
+        percentage=round(run['correct'] / closed * 100, 1) if closed else 0
+    )
 
-def question_timeout(chat_id):
+def advance_run(chat_id, bot_obj, state, verdict, is_correct, timed_out=False):
+    """Отправляет вердикт вместе со следующим вопросом серии; False — серия закончилась"""
+    run = state['run']
+    if is_correct:
+        run['correct'] += 1
+    run['missed'] = run.get('missed', 0) + 1 if timed_out else 0
+    run['pos'] += 1
+    # несколько таймаутов подряд — студент ушёл, не шлём ему оставшиеся вопросы
+    if run['pos'] < len(run['seq']) and run['missed'] < QUIZ_RUN_MAX_TIMEOUTS:
+        ask_question(chat_id, bot_obj, quiz_questions[run['seq'][run['pos']]], prefix=verdict + "\n\n")
+        return True
+
+    bot_obj.send_message(chat_id, f"{verdict}\n\n{run_summary(run)}", MAIN_KEYBOARD)
+    return False
+
+def stop_run(chat_id, bot_obj, state):
+    """Досрочно завершает серию, когда студент переключился на другое действие меню"""
+    if not claim_question(state):
+        return  # вопрос прямо сейчас закрывает ответ или таймаут, серия продолжится
+    timer_manager.cancel_timer(f"quiz_{chat_id}")
+    user_states.pop(chat_id, None)
+    bot_obj.send_message(chat_id, run_summary(state['run']), MAIN_KEYBOARD)
+
+def question_timeout(chat_id, deadline=None):
+    finished = True
     try:
         state = user_states.get(chat_id)
-        if not state or state.get('answered', False):
+        if not state or not claim_question(state, deadline=deadline):
+            # вопрос уже закрыт ответом — сессией распоряжается он
+            finished = False
             return
 
-        state['answered'] = True
         question = state.get('current_question')
         correct = question.get('answer') if question else "—"
+        if question:
+            record_timeout(question, state['deadline'] - state['start_time'])
 
         # update scores
         if chat_id not in user_scores:
@@ -589,57 +1117,52 @@ def question_timeout(chat_id):
         user_scores[chat_id]['total'] += 1
         user_scores[chat_id]['incorrect'] += 1
 
+        if 'run' in state:
+            verdict = RUN_TIMEOUT_TEMPLATE.format(correct=correct)
+            finished = not advance_run(chat_id, bot_instance, state, verdict, False, timed_out=True)
+            return
+
         percentage = round((user_scores[chat_id]['correct'] / user_scores[chat_id]['total']) * 100, 1)
 
-        text = (
-            f"⏰ Время вышло!\n"
-            f"Правильный ответ: <b>{correct}</b>\n\n"
-            f"📊 Ваша статистика:\n"
-            f"Правильных ответов: {user_scores[chat_id]['correct']}\n"
-            f"Всего вопросов: {user_scores[chat_id]['total']}\n"
-            f"Процент правильных: {percentage}%"
+        text = TIMEOUT_TEMPLATE.format(
+            correct=correct,
+            score_correct=user_scores[chat_id]['correct'],
+            total=user_scores[chat_id]['total'],
+            percentage=percentage
         )
 
-        bot_instance.send_message(chat_id, text, get_main_keyboard())
+        bot_instance.send_message(chat_id, text, MAIN_KEYBOARD)
 
     except Exception as e:
         logger.error(f"question_timeout error: {e}")
     finally:
-        if chat_id in user_states:
+        if finished and chat_id in user_states:
             try:
                 del user_states[chat_id]
             except Exception:
                 pass
+        if cluster:
+            cluster.replicate(chat_id)
 
 def show_stats(chat_id):
     if chat_id not in user_scores:
-        bot_instance.send_message(chat_id, "📊 У вас пока нет статистики. Начните викторину!", get_main_keyboard())
+        bot_instance.send_message(chat_id, NO_STATS_MESSAGE)
         return
 
     score = user_scores[chat_id]
     percentage = round((score['correct'] / max(score['total'], 1)) * 100, 1)
-
-    stats_text = (
-        f"📊 <b>Ваша статистика:</b>\n\n"
-        f"👤 Имя: {score.get('name','Аноним')}\n"
-        f"✅ Правильных ответов: {score['correct']}\n"
-        f"❌ Неправильных ответов: {score['incorrect']}\n"
-        f"📝 Всего вопросов: {score['total']}\n"
-        f"📈 Процент правильных: {percentage}%\n\n"
+    level = next(text for threshold, text in STATS_LEVELS if percentage >= threshold)
+
+    stats_text = STATS_TEMPLATE.format(
+        name=score.get('name', 'Аноним'),
+        correct=score['correct'],
+        incorrect=score['incorrect'],
+        total=score['total'],
+        percentage=percentage,
+        level=level
     )
 
-    if percentage >= 90:
-        stats_text += "🏆 <b>Уровень: Эксперт по экономике!</b>"
-    elif percentage >= 75:
-        stats_text += "🥇 <b>Уровень: Продвинутый</b>"
-    elif percentage >= 60:
-        stats_text += "🥈 <b>Уровень: Хороший</b>"
-    elif percentage >= 40:
-        stats_text += "🥉 <b>Уровень: Базовый</b>"
-    else:
-        stats_text += "📚 <b>Уровень: Начинающий</b>"
-
-    bot_instance.send_message(chat_id, stats_text, get_main_keyboard())
+    bot_instance.send_message(chat_id, stats_text, MAIN_KEYBOARD)
 
 # -------------------------
 # Update processing
@@ -656,32 +1179,41 @@ def process_update(bot_obj, update):
             # update last_activity where applicable
             if chat_id and chat_id in user_states:
                 user_states[chat_id]['last_activity'] = time.time()
+                # любое действие из меню во время серии завершает её
+                if 'run' in user_states[chat_id]:
+                    stop_run(chat_id, bot_obj, user_states[chat_id])
 
             # simple command handling
             if text == '/start':
-                bot_obj.send_message(chat_id, "👋 Привет! Я бот по экономической теории. Используй меню ниже.", get_main_keyboard())
+                bot_obj.send_message(chat_id, GREETING_MESSAGE)
                 return
 
             if text == '🖋️ Проверь себя':
                 quiz_question_single(chat_id, bot_obj)
                 return
 
+            if text == '🎯 Серия вопросов' or text == '/run':
+                start_quiz_run(chat_id, bot_obj)
+                return
+
+            if text.startswith('/run '):
+                topic = find_topic(text[5:])
+                if topic:
+                    start_quiz_run(chat_id, bot_obj, topic)
+                else:
+                    bot_obj.send_message(chat_id, RUN_TOPIC_NOT_FOUND_TEMPLATE.format(topics="\n".join(QUIZ_TOPICS)), MAIN_KEYBOARD)
+                return
+
             if text == '📊 Моя статистика':
                 show_stats(chat_id)
                 return
 
             if text == '❓ Помощь' or text == '/help':
-                help_text = (
-                    "❓ <b>Помощь</b>\n\n"
-                    "• Нажмите <b>🖋️ Проверь себя</b> чтобы начать случайный вопрос.\n"
-                    "• Используйте кнопки в викторине (А/Б/В) для ответа.\n"
-                    "• Команда /start — приветствие."
-                )
-                bot_obj.send_message(chat_id, help_text, get_main_keyboard())
+                bot_obj.send_message(chat_id, HELP_MESSAGE)
                 return
 
             # otherwise default reply
-            bot_obj.send_message(chat_id, "Я вас не понял. Используйте кнопки меню.", get_main_keyboard())
+            bot_obj.send_message(chat_id, FALLBACK_MESSAGE)
             return
 
         # handle callback query (inline buttons)
@@ -693,19 +1225,26 @@ def process_update(bot_obj, update):
             chat = message.get('chat', {})
             chat_id = chat.get('id')
 
-            # if it's quiz answer like "quiz_А"
+            # if it's quiz answer like "quiz_А" (or "quiz_А_3" inside a run)
             if data.startswith('quiz_'):
-                answer = data.split('_', 1)[1].strip().upper()
+                answer, _, pos = data.split('_', 1)[1].partition('_')
+                answer = answer.strip().upper()
                 # verify state
                 state = user_states.get(chat_id)
                 if not state or 'current_question' not in state:
                     bot_obj.answer_callback(cb_id, text="Сессия не найдена или время вышло.")
                     return
+                run = state.get('run')
+                # таймаут или повторное нажатие могли закрыть вопрос одновременно с этим ответом
+                if not claim_question(state, pos=pos):
+                    bot_obj.answer_callback(cb_id, text="Этот вопрос уже закрыт." if run else "Сессия не найдена или время вышло.")
+                    return
 
                 # cancel timer
                 timer_manager.cancel_timer(f"quiz_{chat_id}")
 
                 correct = state['current_question'].get('answer', '').strip().upper()
+                record_answer(state['current_question'], time.time() - state['start_time'], answer == correct)
 
                 if chat_id not in user_scores:
                     user_scores[chat_id] = {'name': 'Аноним', 'correct': 0, 'incorrect': 0, 'total': 0}
@@ -715,11 +1254,19 @@ def process_update(bot_obj, update):
                 if answer == correct:
                     user_scores[chat_id]['correct'] += 1
                     bot_obj.answer_callback(cb_id, text="✅ Правильно!")
-                    bot_obj.send_message(chat_id, "✅ <b>Правильно!</b>", get_main_keyboard())
+                    verdict = CORRECT_MESSAGE
                 else:
                     user_scores[chat_id]['incorrect'] += 1
                     bot_obj.answer_callback(cb_id, text=f"❌ Неверно. Правильный ответ: {correct}")
-                    bot_obj.send_message(chat_id, f"❌ Неверно. Правильный ответ: <b>{correct}</b>", get_main_keyboard())
+                    verdict = INCORRECT_MESSAGES.get(correct) or f"❌ Неверно. Правильный ответ: <b>{correct}</b>"
+
+                if run:
+                    # вердикт и следующий вопрос уходят одним сообщением
+                    text = verdict.text if isinstance(verdict, PreparedMessage) else verdict
+                    if advance_run(chat_id, bot_obj, state, text, answer == correct):
+                        return
+                else:
+                    bot_obj.send_message(chat_id, verdict, MAIN_KEYBOARD)
 
                 # cleanup state
                 if chat_id in user_states:
@@ -738,7 +1285,232 @@ def process_update(bot_obj, update):
                 bot_obj.answer_callback(cb_id)
 
     except Exception as e:
-        logger.error(f"process_update error: {e}")
+        logger.exception(f"process_update error: {e}")
+
+def update_chat_id(update):
+    if 'message' in update:
+        return update['message'].get('chat', {}).get('id')
+    if 'callback_query' in update:
+        return update['callback_query'].get('message', {}).get('chat', {}).get('id')
+    return None
+
+def process_owned_update(bot_obj, update):
+    """Обработка апдейта на узле-владельце чата с последующей репликацией"""
+    if cluster:
+        chat_id = update_chat_id(update)
+        if chat_id is not None:
+            cluster.claim(chat_id)
+
+    if not profiler.enabled:
+        process_update(bot_obj, update)
+        if cluster:
+            replicate_update(update)
+        return
+
+    start = profiler.begin(update)
+    try:
+        process_update(bot_obj, update)
+        if cluster:
+            replicate_start = time.perf_counter()
+            replicate_update(update)
+            profiler.add('replicate', time.perf_counter() - replicate_start)
+    finally:
+        profiler.end(start, update)
+
+def replicate_update(update):
+    chat_id = update_chat_id(update)
+    if chat_id is not None:
+        cluster.replicate(chat_id)
+
+def dispatch_update(bot_obj, update):
+    """Обрабатывает апдейт локально или пересылает его узлу-владельцу чата"""
+    chat_id = update_chat_id(update)
+    if cluster is None or chat_id is None:
+        process_owned_update(bot_obj, update)
+        return
+
+    while True:
+        owner = cluster.owner(chat_id)
+        if owner == cluster.self_url:
+            process_owned_update(bot_obj, update)
+            return
+        if cluster.post(owner, '/cluster/update', update):
+            return
+        if owner in cluster.live:
+            # владелец жив, но отверг апдейт — другой узел его сессией не владеет
+            logger.error(f"Update for chat {chat_id} rejected by owner {owner}, dropping it")
+            return
+        # владелец недоступен (post исключил его из кольца) — следующий узел уже держит реплику
+
+# -------------------------
+# Cluster (chat-affinity routing and replication)
+# -------------------------
+class Cluster:
+    """Консистентное хеширование чатов по узлам, репликация сессий и передача таймеров"""
+    def __init__(self, self_url, nodes, secret, replicas=1, heartbeat=2.0):
+        self.self_url = self_url.rstrip('/')
+        self.nodes = sorted({n.rstrip('/') for n in nodes} | {self.self_url})
+        self.secret = secret
+        self.replicas = replicas
+        self.heartbeat = heartbeat
+        self.live = set(self.nodes)
+        self.replica_states = {}
+        self.lock = threading.Lock()
+        self.rebalance_pending = threading.Event()  # будит поток heartbeat, см. mark_dead
+
+        ring = sorted((self._hash(f"{node}#{i}"), node) for node in self.nodes for i in range(CLUSTER_VNODES))
+        self.ring_keys = [h for h, _ in ring]
+        self.ring_nodes = [node for _, node in ring]
+
+    @staticmethod
+    def _hash(key):
+        return int.from_bytes(hashlib.md5(str(key).encode('utf-8')).digest()[:8], 'big')
+
+    def nodes_for(self, chat_id):
+        """Живые узлы для чата: первый — владелец, дальше — реплики"""
+        live = self.live
+        result = []
+        start = bisect.bisect(self.ring_keys, self._hash(chat_id))
+        for i in range(len(self.ring_nodes)):
+            node = self.ring_nodes[(start + i) % len(self.ring_nodes)]
+            if node in live and node not in result:
+                result.append(node)
+                if len(result) > self.replicas:
+                    break
+        return result
+
+    def owner(self, chat_id):
+        return self.nodes_for(chat_id)[0]
+
+    def authorized(self, req):
+        token = req.headers.get('X-Cluster-Secret', '')
+        return hmac.compare_digest(token.encode('utf-8'), self.secret.encode('utf-8'))
+
+    def post(self, node, path, payload):
+        """POST на другой узел; недоступный узел (соединение, таймаут) сразу исключается из кольца"""
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        req = urllib.request.Request(f"{node}{path}", data=body)
+        req.add_header('Content-Type', 'application/json; charset=utf-8')
+        req.add_header('X-Cluster-Secret', self.secret)
+        try:
+            with urllib.request.urlopen(req, timeout=3) as resp:
+                return resp.status == 200
+        except urllib.error.HTTPError as e:
+            # узел ответил — он жив, ошибка в запросе (например, не совпал CLUSTER_SECRET)
+            logger.error(f"Cluster request to {node}{path} rejected: {e}")
+            return False
+        except (urllib.error.URLError, OSError) as e:
+            logger.error(f"Cluster request to {node}{path} failed: {e}")
+            self.mark_dead(node)
+            return False
+
+    def ping(self, node):
+        try:
+            with urllib.request.urlopen(f"{node}/healthz", timeout=1) as resp:
+                return resp.status == 200
+        except Exception:
+            return False
+
+    def snapshot(self, chat_id):
+        return {'chat_id': chat_id, 'state': user_states.get(chat_id), 'score': user_scores.get(chat_id)}
+
+    def replicate(self, chat_id):
+        payload = None
+        for node in self.nodes_for(chat_id)[1:]:
+            if payload is None:
+                payload = dict(self.snapshot(chat_id), role='replica')
+            self.post(node, '/cluster/state', payload)
+
+    def install(self, payload):
+        """Принимает состояние чата от другого узла"""
+        chat_id = payload['chat_id']
+        if payload.get('role') == 'owner':
+            self.replica_states.pop(chat_id, None)
+            self._promote(payload)
+            # прежний владелец удаляет свою копию — без этого у чата не осталось бы реплики
+            self.replicate(chat_id)
+        elif payload.get('state') is None and payload.get('score') is None:
+            self.replica_states.pop(chat_id, None)
+        else:
+            self.replica_states[chat_id] = payload
+
+    def _promote(self, payload):
+        chat_id = payload['chat_id']
+        state = payload.get('state')
+        if payload.get('score') is not None:
+            user_scores[chat_id] = payload['score']
+        if state is None:
+            user_states.pop(chat_id, None)
+            return
+
+        user_states[chat_id] = state
+        # переносим незавершённый таймер вопроса с оставшимся временем
+        if state.get('mode') == 'quiz' and not state.get('answered') and 'deadline' in state:
+            remaining = max(0.0, state['deadline'] - time.time())
+            timer_manager.set_timer(f"quiz_{chat_id}", remaining, question_timeout, chat_id, state['deadline'])
+
+    def claim(self, chat_id):
+        """Поднимает реплику чата, если апдейт пришёл раньше, чем heartbeat заметил смену владельца"""
+        payload = self.replica_states.pop(chat_id, None)
+        if payload is not None:
+            self._promote(payload)
+
+    def mark_dead(self, node):
+        with self.lock:
+            if node not in self.live or node == self.self_url:
+                return
+            self.live.discard(node)
+        logger.warning(f"Cluster node {node} is down")
+        # перебалансировка рассылает состояние всех чатов — не на пути апдейта студента
+        self.rebalance_pending.set()
+
+    def rebalance(self):
+        logger.info(f"Cluster membership: {sorted(self.live)}")
+        # реплики чатов, которыми теперь владеем мы: поднимаем сессии и таймеры
+        for chat_id, payload in list(self.replica_states.items()):
+            if self.owner(chat_id) == self.self_url:
+                self.replica_states.pop(chat_id, None)
+                self._promote(payload)
+                self.replicate(chat_id)
+
+        # чаты, которые переехали на другой узел: передаём их новому владельцу
+        for chat_id in set(user_states) | set(user_scores):
+            owner = self.owner(chat_id)
+            if owner == self.self_url:
+                self.replicate(chat_id)
+            elif self.post(owner, '/cluster/state', dict(self.snapshot(chat_id), role='owner')):
+                timer_manager.cancel_timer(f"quiz_{chat_id}")
+                user_states.pop(chat_id, None)
+                user_scores.pop(chat_id, None)
+
+    def _heartbeat_loop(self):
+        while True:
+            self.rebalance_pending.wait(self.heartbeat)
+            changed = self.rebalance_pending.is_set()
+            self.rebalance_pending.clear()
+            for node in self.nodes:
+                if node == self.self_url:
+                    continue
+                alive = self.ping(node)
+                with self.lock:
+                    if alive and node not in self.live:
+                        self.live.add(node)
+                        changed = True
+                    elif not alive and node in self.live:
+                        self.live.discard(node)
+                        changed = True
+            if changed:
+                try:
+                    self.rebalance()
+                except Exception as e:
+                    logger.error(f"Cluster rebalance error: {e}")
+
+    def start(self):
+        thread = threading.Thread(target=self._heartbeat_loop, daemon=True)
+        thread.start()
+        return thread
+
+cluster = Cluster(CLUSTER_SELF_URL, CLUSTER_NODES, CLUSTER_SECRET, CLUSTER_REPLICAS, CLUSTER_HEARTBEAT) if CLUSTER_NODES else None
 
 # -------------------------
 # Flask app and webhook
@@ -750,17 +1522,65 @@ bot_instance = TelegramBot(TOKEN)
 def healthz():
     return jsonify({"status": "ok"})
 
+# Грубый фильтр по сырому телу: апдейт без этих байтов точно нам не нужен. Обратное неверно —
+# '"message"' встречается и в чужих апдейтах (например, текст сообщения ровно "message"),
+# поэтому после разбора JSON ключи верхнего уровня обязательно проверяются ещё раз
+ALLOWED_UPDATE_MARKERS = tuple(f'"{kind}"'.encode('utf-8') for kind in ALLOWED_UPDATES)
+ACK_RESPONSE = ('{"ok":true}', 200, {'Content-Type': 'application/json'})
+
 @app.route("/webhook", methods=["POST"])
 def webhook():
+    if WEBHOOK_SECRET:
+        token = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+        if not hmac.compare_digest(token.encode('utf-8'), WEBHOOK_SECRET.encode('utf-8')):
+            return jsonify({"ok": False}), 403
     try:
-        update = request.get_json(force=True)
+        body = request.get_data(cache=False)
+        # неинтересные апдейты подтверждаем без разбора JSON, иначе Telegram будет их переотправлять
+        if not any(marker in body for marker in ALLOWED_UPDATE_MARKERS):
+            return ACK_RESPONSE
+        update = json_loads(body)
+        # не убирать: байтовый фильтр выше пропускает ложные совпадения
+        if not any(kind in update for kind in ALLOWED_UPDATES):
+            return ACK_RESPONSE
         # process update in background thread to return 200 quickly
-        threading.Thread(target=process_update, args=(bot_instance, update), daemon=True).start()
-        return jsonify({"ok": True})
+        threading.Thread(target=dispatch_update, args=(bot_instance, update), daemon=True).start()
+        return ACK_RESPONSE
     except Exception as e:
         logger.error(f"Webhook handling error: {e}")
         return jsonify({"ok": False, "error": str(e)}), 500
 
+@app.route("/admin/profiler", methods=["GET", "POST"])
+def admin_profiler():
+    """POST {"spans": bool, "sampler": bool} переключает профилирование; GET — агрегаты и горячие стеки"""
+    token = request.headers.get('X-Admin-Token', '')
+    if not ADMIN_TOKEN or not hmac.compare_digest(token.encode('utf-8'), ADMIN_TOKEN.encode('utf-8')):
+        return jsonify({"ok": False}), 403
+    if request.method == "POST":
+        options = request.get_json(force=True, silent=True) or {}
+        if 'spans' in options:
+            profiler.set_spans(bool(options['spans']))
+        if options.get('sampler') is True:
+            profiler.start_sampler()
+        elif options.get('sampler') is False:
+            profiler.stop_sampler()
+    return jsonify(profiler.report(request.args.get('limit', 20, type=int)))
+
+@app.route("/cluster/update", methods=["POST"])
+def cluster_update():
+    if cluster is None or not cluster.authorized(request):
+        return jsonify({"ok": False}), 403
+    update = request.get_json(force=True)
+    threading.Thread(target=process_owned_update, args=(bot_instance, update), daemon=True).start()
+    return jsonify({"ok": True})
+
+@app.route("/cluster/state", methods=["POST"])
+def cluster_state():
+    if cluster is None or not cluster.authorized(request):
+        return jsonify({"ok": False}), 403
+    cluster.install(request.get_json(force=True))
+    return jsonify({"ok": True})
+
 # -------------------------
 # Startup: set webhook then run Flask
 # -------------------------
@@ -779,7 +1599,9 @@ def set_telegram_webhook():
     logger.info(f"Setting Telegram webhook to: {url}")
 
     try:
-        result = bot_instance.set_webhook(url)
+        if not WEBHOOK_SECRET:
+            logger.warning("WEBHOOK_SECRET is not set, webhook requests are not authenticated.")
+        result = bot_instance.set_webhook(url, allowed_updates=ALLOWED_UPDATES, secret_token=WEBHOOK_SECRET)
         logger.info(f"setWebhook result: {result}")
         return result
     except Exception as e:
@@ -792,6 +1614,9 @@ def set_telegram_webhook():
 if __name__ == "__main__":
     # Try to set webhook before starting server
     res = set_telegram_webhook()
+    start_calibration_job()
+    if cluster:
+        cluster.start()
     # If webhook couldn't be set, we still start server — Telegram won't push updates until webhook is set.
     logger.info(f"Starting Flask on 0.0.0.0:{PORT}")
     app.run(host="0.0.0.0", port=PORT)